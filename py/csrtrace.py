@@ -0,0 +1,359 @@
+"""Replay traces of CSR instructions against a set of CSR definitions.
+
+A trace is a flat binary file of TRACE_DTYPE records, one per csrrw, csrrs, or
+csrrc instruction (the immediate forms are recorded with their zero-extended
+immediate as the operand). Traces are read in chunks through np.memmap and
+each chunk is applied with vectorized NumPy operations.
+
+CSRs that share fields (e.g. mstatus and sstatus) are placed in the same
+storage group. Each storage group packs the stateful fields of its CSRs into
+one 64-bit word per hart, and every access is translated from the bit layout
+of its CSR into the bit layout of its storage group before it is applied.
+"""
+import os
+import sys
+import time
+import numpy as np
+from csrs import ReadOnly
+
+CSRRW = 1
+CSRRS = 2
+CSRRC = 3
+
+op_names = { CSRRW : 'csrrw', CSRRS : 'csrrs', CSRRC : 'csrrc' }
+
+TRACE_DTYPE = np.dtype([('operand', '<u8'),
+                        ('address', '<u2'),
+                        ('op', 'u1'),
+                        ('hart', 'u1'),
+                        ('reserved', '<u4')])
+
+def all_ones(width):
+    return (1 << width) - 1
+
+def csr_layout(csr):
+    """Return a list of (field, lsb) pairs for the fields of csr."""
+    layout = []
+    lsb = csr.get_width()
+    for field in csr.fields:
+        lsb -= field.width
+        layout.append((field, lsb))
+    return layout
+
+class StorageGroup:
+    """CSRs whose fields alias one another, backed by one storage word."""
+    def __init__(self, index):
+        self.index = index
+        self.csrs = []
+        # field name -> (lsb within the storage word, width)
+        self.fields = {}
+        self.width = 0
+    def add_field(self, field):
+        if field.name not in self.fields:
+            self.fields[field.name] = (self.width, field.width)
+            self.width += field.width
+            if self.width > 64:
+                raise ValueError("Fields aliased by CSRs %s do not fit in 64 bits" % ', '.join(csr.name for csr in self.csrs))
+
+class CSRMapping:
+    """Translation between the bit layout of a CSR and its storage group."""
+    def __init__(self, csr, group):
+        self.csr = csr
+        self.group = group
+        self.csr_mask = all_ones(csr.get_width())
+        # (shift from csr bit to storage bit, csr bit mask) for fields that
+        # can be read and for fields that can be written
+        self.read_shifts = []
+        self.write_shifts = []
+        for field, lsb in csr_layout(csr):
+            if not field.holds_state():
+                continue
+            store_lsb, width = group.fields[field.name]
+            self.read_shifts.append((store_lsb - lsb, all_ones(width) << lsb))
+            if not isinstance(field, ReadOnly):
+                self.write_shifts.append((store_lsb - lsb, all_ones(width) << lsb))
+        self.read_shifts = merge_shifts(self.read_shifts)
+        self.write_shifts = merge_shifts(self.write_shifts)
+        self.write_mask = shift_bits(self.csr_mask, self.write_shifts)
+    def to_csr(self, stored):
+        """Return the value read from the CSR given its storage word."""
+        value = 0
+        for shift, mask in self.read_shifts:
+            if shift >= 0:
+                value |= (stored >> shift) & mask
+            else:
+                value |= (stored << -shift) & mask
+        return value
+    def to_storage(self, operand):
+        """Return the storage bits written by operand as a python int."""
+        return shift_bits(operand, self.write_shifts)
+    def to_storage_array(self, operand):
+        """Return the storage bits written by an array of uint64 operands."""
+        if len(self.write_shifts) == 0:
+            return np.zeros_like(operand)
+        bits = None
+        for shift, mask in self.write_shifts:
+            part = operand & np.uint64(mask)
+            if shift > 0:
+                part <<= np.uint64(shift)
+            elif shift < 0:
+                part >>= np.uint64(-shift)
+            if bits is None:
+                bits = part
+            else:
+                bits |= part
+        return bits
+
+def merge_shifts(shifts):
+    """Combine the masks of fields that move by the same shift."""
+    merged = {}
+    for shift, mask in shifts:
+        merged[shift] = merged.get(shift, 0) | mask
+    return sorted(merged.items())
+
+def shift_bits(value, shifts):
+    bits = 0
+    for shift, mask in shifts:
+        if shift >= 0:
+            bits |= (value & mask) << shift
+        else:
+            bits |= (value & mask) >> -shift
+    return bits
+
+class CSRModel:
+    """Architectural state of a set of CSRs for one or more harts.
+
+    Accesses to addresses that do not belong to any of the CSRs are counted in
+    self.unmapped and otherwise ignored. WARL and WLRL fields store whatever
+    is written to them since csrs.Field does not describe their legal values.
+    """
+    def __init__(self, csrs, num_harts = 1):
+        if num_harts < 1 or num_harts > 256:
+            raise ValueError("num_harts must be between 1 and 256")
+        self.num_harts = num_harts
+        self.csrs = list(csrs)
+        self.groups = []
+        self.mappings = []
+        addresses = set()
+        for csr in self.csrs:
+            if csr.address in addresses:
+                raise ValueError("Multiple CSRs use address %s" % hex(csr.address))
+            addresses.add(csr.address)
+        self._build_groups()
+        self.by_address = {}
+        # lookup tables indexed by address for the vectorized path
+        self.address_index = np.full(1 << 16, -1, dtype = np.int64)
+        self.address_group = np.full(1 << 16, -1, dtype = np.int64)
+        for index, mapping in enumerate(self.mappings):
+            self.by_address[mapping.csr.address] = mapping
+            self.address_index[mapping.csr.address] = index
+            self.address_group[mapping.csr.address] = mapping.group.index
+        self.state = np.zeros((num_harts, len(self.groups)), dtype = np.uint64)
+        self.histogram = np.zeros((num_harts, len(self.csrs), 4), dtype = np.int64)
+        self.unmapped = 0
+
+    def _build_groups(self):
+        # merge CSRs that share a stateful field into one storage group
+        parent = list(range(len(self.csrs)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        owner = {}
+        for i, csr in enumerate(self.csrs):
+            for field in csr.fields:
+                if field.holds_state():
+                    if field.name in owner:
+                        parent[find(i)] = find(owner[field.name])
+                    else:
+                        owner[field.name] = i
+        groups = {}
+        for i, csr in enumerate(self.csrs):
+            root = find(i)
+            if root not in groups:
+                groups[root] = StorageGroup(len(self.groups))
+                self.groups.append(groups[root])
+            groups[root].csrs.append(csr)
+        for group in self.groups:
+            for csr in group.csrs:
+                for field in csr.fields:
+                    if field.holds_state():
+                        group.add_field(field)
+        self.mappings = [CSRMapping(csr, groups[find(i)]) for i, csr in enumerate(self.csrs)]
+
+    def read(self, hart, address):
+        """Return the current value of the CSR at address."""
+        mapping = self.by_address[address]
+        return mapping.to_csr(int(self.state[hart, mapping.group.index]))
+
+    def access(self, hart, address, op, operand):
+        """Apply a single CSR instruction and return the old CSR value.
+
+        This is the reference implementation of the semantics used by replay.
+        """
+        if op not in op_names:
+            raise ValueError("Unknown CSR operation %d" % op)
+        mapping = self.by_address.get(address)
+        if mapping is None:
+            self.unmapped += 1
+            return None
+        self.histogram[hart, self.address_index[address], op] += 1
+        stored = int(self.state[hart, mapping.group.index])
+        old = mapping.to_csr(stored)
+        bits = mapping.to_storage(operand & mapping.csr_mask)
+        if op == CSRRW:
+            stored = (stored & ~mapping.write_mask) | bits
+        elif op == CSRRS:
+            stored |= bits
+        else:
+            stored &= ~bits
+        self.state[hart, mapping.group.index] = stored
+        return old
+
+    def replay(self, records):
+        """Apply an array of TRACE_DTYPE records in order."""
+        if len(records) == 0:
+            return
+        address = records['address']
+        op = records['op']
+        hart = records['hart']
+        if op.min() < CSRRW or op.max() > CSRRC:
+            raise ValueError("Unknown CSR operation in trace")
+        if hart.max() >= self.num_harts:
+            raise ValueError("Trace contains hart %d but the model has %d harts" % (hart.max(), self.num_harts))
+        index = self.address_index[address]
+        mapped = index >= 0
+        num_mapped = np.count_nonzero(mapped)
+        if num_mapped != len(records):
+            self.unmapped += len(records) - num_mapped
+            records = records[mapped]
+            address = records['address']
+            op = records['op']
+            hart = records['hart']
+            index = index[mapped]
+        ncsrs = len(self.csrs)
+        self.histogram += np.bincount((hart.astype(np.int64) * ncsrs + index) * 4 + op,
+                minlength = self.num_harts * ncsrs * 4).reshape(self.histogram.shape)
+
+        # stable sort by (hart, storage group) so each group's accesses are
+        # contiguous and still in trace order
+        ngroups = len(self.groups)
+        key = hart.astype(np.int64) * ngroups + self.address_group[address]
+        if self.num_harts * ngroups <= (1 << 16):
+            key = key.astype(np.uint16)
+        order = np.argsort(key, kind = 'stable')
+        counts = np.bincount(key, minlength = self.num_harts * ngroups)
+        ends = np.cumsum(counts)
+        address = address[order]
+        op = op[order]
+        operand = records['operand'][order]
+
+        state = self.state.reshape(-1)
+        for group_key in np.flatnonzero(counts):
+            end = ends[group_key]
+            start = end - counts[group_key]
+            group = self.groups[group_key % ngroups]
+            touched, written = self._translate(group, address[start:end], op[start:end], operand[start:end])
+            # a bit ends up with the value from the last access that touched
+            # it, i.e. the access that touched it with no later access doing so
+            later = np.bitwise_or.accumulate(touched[::-1])[::-1]
+            final = np.bitwise_or.reduce(written[:-1] & ~later[1:]) | written[-1]
+            state[group_key] = (state[group_key] & ~later[0]) | final
+
+    def _translate(self, group, address, op, operand):
+        """Return the storage bits touched and written by each access."""
+        if len(group.csrs) == 1:
+            return self._translate_csr(self.by_address[group.csrs[0].address], op, operand)
+        touched = np.empty_like(operand)
+        written = np.empty_like(operand)
+        for csr in group.csrs:
+            selected = address == csr.address
+            if selected.any():
+                mapping = self.by_address[csr.address]
+                touched[selected], written[selected] = self._translate_csr(mapping, op[selected], operand[selected])
+        return touched, written
+
+    def _translate_csr(self, mapping, op, operand):
+        bits = mapping.to_storage_array(operand)
+        is_write = op == CSRRW
+        touched = np.where(is_write, np.uint64(mapping.write_mask), bits)
+        written = np.where(op == CSRRC, np.uint64(0), bits)
+        return touched, written
+
+    def replay_file(self, path, chunk_size = 1 << 20):
+        """Apply every record of a trace file, chunk_size records at a time."""
+        size = os.path.getsize(path)
+        if size % TRACE_DTYPE.itemsize != 0:
+            raise ValueError("Trace file size is not a multiple of %d bytes" % TRACE_DTYPE.itemsize)
+        if size == 0:
+            return 0
+        records = np.memmap(path, dtype = TRACE_DTYPE, mode = 'r')
+        for start in range(0, len(records), chunk_size):
+            self.replay(np.asarray(records[start:start + chunk_size]))
+        return len(records)
+
+    def final_state(self):
+        """Return a list with a dictionary of CSR name to value for each hart."""
+        return [dict((csr.name, self.read(hart, csr.address)) for csr in self.csrs)
+                for hart in range(self.num_harts)]
+
+    def access_histogram(self, hart = None):
+        """Return a dictionary of CSR name to per-operation access counts.
+
+        Counts are summed over all harts unless hart is given."""
+        if hart is None:
+            counts = self.histogram.sum(axis = 0)
+        else:
+            counts = self.histogram[hart]
+        histogram = {}
+        for index, csr in enumerate(self.csrs):
+            histogram[csr.name] = dict((name, int(counts[index, op])) for op, name in op_names.items())
+        return histogram
+
+def random_trace(csrs, num_records, num_harts = 1, seed = 0):
+    """Create an array of random TRACE_DTYPE records over the given CSRs."""
+    rng = np.random.default_rng(seed)
+    addresses = np.array([csr.address for csr in csrs], dtype = np.uint16)
+    records = np.zeros(num_records, dtype = TRACE_DTYPE)
+    records['address'] = addresses[rng.integers(0, len(addresses), num_records)]
+    records['op'] = rng.integers(CSRRW, CSRRC + 1, num_records)
+    records['hart'] = rng.integers(0, num_harts, num_records)
+    # sparse set/clear operands like real csrrs/csrrc usage
+    operand = rng.integers(0, np.iinfo(np.uint64).max, num_records, dtype = np.uint64, endpoint = True)
+    sparse = rng.integers(0, 64, num_records, dtype = np.uint64)
+    records['operand'] = np.where(records['op'] == CSRRW, operand, np.uint64(1) << sparse)
+    return records
+
+if __name__ == '__main__':
+    import tempfile
+    from spec import all_real_csrs
+
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 1 << 24
+    num_harts = 4
+
+    # check the vectorized replay against the reference implementation
+    records = random_trace(all_real_csrs, 100000, num_harts, seed = 1)
+    reference = CSRModel(all_real_csrs, num_harts)
+    for record in records:
+        reference.access(int(record['hart']), int(record['address']), int(record['op']), int(record['operand']))
+    model = CSRModel(all_real_csrs, num_harts)
+    for start in range(0, len(records), 4096):
+        model.replay(records[start:start + 4096])
+    if model.final_state() != reference.final_state() or model.access_histogram() != reference.access_histogram():
+        raise ValueError("replay results don't match reference results")
+    print('replay matches reference for %d records' % len(records))
+
+    # benchmark replay of a memory-mapped trace file
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'trace.bin')
+        random_trace(all_real_csrs, num_records, num_harts).tofile(path)
+        model = CSRModel(all_real_csrs, num_harts)
+        start = time.perf_counter()
+        model.replay_file(path)
+        elapsed = time.perf_counter() - start
+    print('replayed %d records in %.3f s (%.1f M ops/s)' % (num_records, elapsed, num_records / elapsed / 1e6))
+    for name, counts in model.access_histogram().items():
+        print('    %-10s %s' % (name, ' '.join('%s=%d' % item for item in counts.items())))
+    for name, value in model.final_state()[0].items():
+        print('    hart0 %-10s = %s' % (name, hex(value)))
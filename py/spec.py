@@ -178,7 +178,7 @@ CSR("mstatus", 0x300,
 CSR("mtvec", 0x305,
         mtvec_base, mtvec_mode)
 CSR("medeleg", 0x302, medeleg)
-CSR("mideleg", 0x302, mideleg)
+CSR("mideleg", 0x303, mideleg)
 CSR("mip", 0x344,
         WIRI(xlen-12), ReadOnly(meip), WIRI(1), seip, ueip, ReadOnly(mtip), WIRI(1), stip, utip, ReadOnly(msip), WIRI(1), ssip, usip)
 CSR("mie", 0x304,
@@ -216,19 +216,21 @@ CSR("frm", 0x002, WIRI(xlen-3), frm)
 CSR("fcsr", 0x003, WPRI(xlen-8), frm, fflags)
 
 if use_symbolic:
-    print('symbolic example:')
-    print('str(vm_mode) = ' + str(vm_mode))
     # if using symbolic operations, evaluate all the CSRs to populate the
     # all_real_csrs list
     for symb_csr in all_symb_csrs:
         compute(symb_csr, { 'xlen' : 64 })
 
-print('\nFields:\n    ' + ('\n    '.join(map(str, all_real_fields))))
-print('\nCSRs:\n    ' + ('\n    '.join(map(str, all_real_csrs))))
-print('\nBSV:')
-print('    \\\\ Field Definitions')
-for field in all_real_fields:
-    print('    ' + bsvprinter.bsv_field_init(field))
-print('    \\\\ CSR Definitions')
-for csr in all_real_csrs:
-    print('    ' + bsvprinter.bsv_csr_init(csr))
+if __name__ == '__main__':
+    if use_symbolic:
+        print('symbolic example:')
+        print('str(vm_mode) = ' + str(vm_mode))
+    print('\nFields:\n    ' + ('\n    '.join(map(str, all_real_fields))))
+    print('\nCSRs:\n    ' + ('\n    '.join(map(str, all_real_csrs))))
+    print('\nBSV:')
+    print('    \\\\ Field Definitions')
+    for field in all_real_fields:
+        print('    ' + bsvprinter.bsv_field_init(field))
+    print('    \\\\ CSR Definitions')
+    for csr in all_real_csrs:
+        print('    ' + bsvprinter.bsv_csr_init(csr))